@@ -141,7 +141,8 @@ echo ""
 
 # Step 1: Create input JSON and upload to S3
 print_status "Creating input JSON and uploading to S3..."
-INPUT_JSON="{\"prompt\": \"$PROMPT\"}"
+# Request PNG output to match the .png default/extension of OUTPUT_FILE
+INPUT_JSON="{\"prompt\": \"$PROMPT\", \"fmt\": \"png\"}"
 echo "$INPUT_JSON" > /tmp/input_${TIMESTAMP}.json
 
 aws s3 cp /tmp/input_${TIMESTAMP}.json "$INPUT_S3_URI" --quiet
@@ -212,10 +213,18 @@ if aws s3 ls "$OUTPUT_LOCATION" &>/dev/null; then
     curl -s "$PRESIGNED_URL" -o /tmp/result_${TIMESTAMP}.json
     
     # Step 6: Extract and save image
+    # The endpoint returns raw image bytes; older deployments wrapped the
+    # image in JSON+base64, so fall back to decoding that shape
     print_status "Extracting image data..."
-    if cat /tmp/result_${TIMESTAMP}.json | jq -r '.image' | base64 -d > "$OUTPUT_FILE" 2>/dev/null; then
+    if jq -er '.image' /tmp/result_${TIMESTAMP}.json >/dev/null 2>&1; then
+        cat /tmp/result_${TIMESTAMP}.json | jq -r '.image' | base64 -d > "$OUTPUT_FILE"
         rm /tmp/result_${TIMESTAMP}.json
-        
+    else
+        mv /tmp/result_${TIMESTAMP}.json "$OUTPUT_FILE"
+    fi
+
+    if [[ -s "$OUTPUT_FILE" ]]; then
+
         # Get image info
         IMAGE_SIZE=$(ls -lh "$OUTPUT_FILE" | awk '{print $5}')
         
@@ -231,7 +240,7 @@ if aws s3 ls "$OUTPUT_LOCATION" &>/dev/null; then
         
     else
         print_error "Failed to decode image data"
-        rm /tmp/result_${TIMESTAMP}.json
+        rm -f /tmp/result_${TIMESTAMP}.json "$OUTPUT_FILE"
         exit 1
     fi
     
@@ -1,12 +1,24 @@
 # src/inference_handler.py
 # Pure SageMaker inference handler - no authentication logic
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, Response, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, StringConstraints
+from typing import Annotated, Literal
 import base64
+import functools
 from io import BytesIO
-from src.model_loader import get_pipeline
+from src.model_loader import (
+    get_pipeline,
+    get_device,
+    inference_dtype,
+    ipex_optimized,
+    QUANTIZE_UNET,
+    USE_ORT,
+)
 import torch
+from torch.nn.attention import SDPBackend, sdpa_kernel
+import asyncio
+import concurrent.futures
 from contextlib import nullcontext
 import logging
 import json
@@ -14,18 +26,19 @@ import os
 from datetime import datetime
 
 try:
-    import boto3
-    from botocore.exceptions import ClientError
-    HAS_BOTO3 = True
+    import pybase64
+    HAS_PYBASE64 = True
 except ImportError:
-    HAS_BOTO3 = False
-    boto3 = None
+    HAS_PYBASE64 = False
+    pybase64 = None
 
-try:
-    from torch.cuda.amp import autocast
-    HAS_CUDA_AMP = True
-except Exception:
-    HAS_CUDA_AMP = False
+# Let any residual fp32 matmuls/convs (LayerNorm stats, VAE tail) use TF32
+# tensor cores on Ampere+, and let cuDNN autotune conv algos for our fixed
+# 512x512 shapes - one-time tuning cost, then every step reuses the winner
+torch.set_float32_matmul_precision("high")
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
 
 logging.basicConfig(
     level=logging.INFO,
@@ -48,19 +61,127 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Simple Prompt model for the predict endpoint
+# Per-format PIL save options. WebP is the default: 3-10x faster to encode
+# than single-threaded libpng deflate and a 5-10x smaller payload, which
+# matters because encoding sits on the request's critical path.
+IMAGE_SAVE_KWARGS = {
+    "png": {"format": "PNG"},
+    "webp": {"format": "WEBP", "quality": 90, "method": 4},
+    "jpeg": {"format": "JPEG", "quality": 90},
+}
+
+
+# Single-slot GPU gate: only one request runs on the GPU at a time, but the
+# blocking pipe(...) call happens on a dedicated worker thread so the event
+# loop stays free to answer /ping (SageMaker health checks must not time out
+# behind a long generation).
+_gpu_sema = asyncio.Semaphore(1)
+_gpu_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="gpu-infer"
+)
+
+# Micro-batching: prompts that arrive within MAX_WAIT_MS of each other are
+# coalesced into a single batched pipe(...) call. At bs=1 the SDXL-Turbo UNet
+# is launch-overhead-bound, so batching scales throughput nearly linearly for
+# a few milliseconds of added latency.
+MAX_BATCH = int(os.getenv("MAX_BATCH", "4"))
+MAX_WAIT_MS = float(os.getenv("MAX_WAIT_MS", "10"))
+
+_batch_queue: asyncio.Queue = asyncio.Queue()
+_batch_task = None
+
+# Bound once in startup_event after load/compile/warmup; hot paths read this
+# directly instead of going back through get_pipeline()
+_PIPE = None
+
+# Persistent initial-noise buffer for the fixed 512x512 latent shape, refilled
+# in place per request so the hot path does no cudaMalloc/cudaFree
+_LATENT_BUF = None
+_LATENT_GEN = None
+
+
+# Simple Prompt model for the predict endpoint. The prompt constraints run in
+# pydantic-core (Rust) during request parsing, so /predict never reaches the
+# handler with an empty or oversized prompt.
 class Prompt(BaseModel):
-    prompt: str
+    prompt: Annotated[
+        str, StringConstraints(min_length=1, max_length=1000, strip_whitespace=True)
+    ]
+    fmt: Literal["png", "webp", "jpeg"] = "webp"
 
 
 @app.on_event("startup")
 async def startup_event():
     """Load and warm up model on startup for SageMaker inference"""
     logger.info("SageMaker inference service starting with optimized model loading...")
-    
+
     # Load model with optimizations and warmup
     try:
-        get_pipeline()
+        pipe = get_pipeline()
+
+        if torch.cuda.is_available() and not USE_ORT:
+            # Prime scheduler sigma/timestep buffers and pre-allocate the
+            # initial-noise latents for the fixed shape before serving
+            global _LATENT_BUF, _LATENT_GEN
+            pipe.scheduler.set_timesteps(10, device="cuda")
+            _LATENT_BUF = torch.empty(
+                (MAX_BATCH, pipe.unet.config.in_channels, 64, 64),
+                dtype=pipe.unet.dtype,
+                device="cuda",
+            )
+            _LATENT_GEN = torch.Generator(device="cuda")
+
+            # Compile the UNet once at startup so TorchInductor's CUDA-graph
+            # capture amortizes over every subsequent request. Shapes are fixed
+            # (1x512x512, 10 steps) so fullgraph compilation never retraces.
+            # int8-quantized weights don't mix with cudagraph capture, so the
+            # quantized path uses max-autotune without graphs instead
+            if QUANTIZE_UNET:
+                compile_mode = "max-autotune-no-cudagraphs"
+            else:
+                compile_mode = "reduce-overhead"
+            logger.info(f"Compiling UNet with torch.compile(mode='{compile_mode}')...")
+            pipe.unet.to(memory_format=torch.channels_last)
+            pipe.vae.to(memory_format=torch.channels_last)
+            pipe.unet = torch.compile(pipe.unet, mode=compile_mode, fullgraph=True)
+            # VAE decode runs once per request after the denoise loop; default
+            # compile mode is enough to fuse its conv/upsample tail
+            pipe.vae.decode = torch.compile(pipe.vae.decode)
+
+            # Warmup forwards trigger Dynamo tracing + cudagraph capture
+            # before SageMaker routes any traffic to us. The batch worker
+            # submits batches of 1..MAX_BATCH prompts and fullgraph compile
+            # specializes on batch size, so warm every size now rather than
+            # stalling a live request on a mid-traffic recompile.
+            logger.info(f"Running warmup inference for batch sizes 1-{MAX_BATCH}...")
+            with torch.inference_mode():
+                for batch_size in range(1, MAX_BATCH + 1):
+                    pipe(
+                        ["warmup"] * batch_size,
+                        num_inference_steps=1,
+                        guidance_scale=0.0,
+                        height=512,
+                        width=512,
+                    )
+            logger.info("Warmup complete - compiled graphs captured")
+
+            # guidance_scale=0.0 must take the CFG-off path (single latent per
+            # prompt, half the UNet FLOPs per step). diffusers short-circuits
+            # the 2x batch doubling when guidance_scale <= 1.0; verify against
+            # the warmup run so a dependency bump can't silently regress this.
+            if getattr(pipe, "do_classifier_free_guidance", False):
+                logger.warning(
+                    "⚠️ Warmup ran with classifier-free guidance enabled - the UNet "
+                    "is doing 2x work per step. Check that the installed diffusers "
+                    "disables CFG for guidance_scale <= 1.0"
+                )
+            else:
+                logger.info("CFG-off path confirmed - single-latent UNet batches")
+
+        global _PIPE, _batch_task
+        _PIPE = pipe
+        _batch_task = asyncio.create_task(_batch_worker())
+
         logger.info("✅ Model loaded, warmed up, and ready for inference!")
     except Exception as e:
         logger.error(f"❌ Model loading failed: {e}")
@@ -70,13 +191,17 @@ async def startup_event():
 @app.get("/ping")
 async def ping():
     """SageMaker health check endpoint - should return 200 when service is ready"""
+    # SageMaker polls this at high frequency; a flag check keeps it in the
+    # low-millisecond range with no loader involvement
+    if _PIPE is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
     return {"status": "ok", "service": "sagemaker-inference"}
 
 
 @app.post("/predict")
 async def predict(data: Prompt):
     """Standard inference endpoint"""
-    return await _run_inference(data.prompt)
+    return await _run_inference(data.prompt, fmt=data.fmt)
 
 
 @app.post("/invocations")
@@ -86,7 +211,7 @@ async def invocations(request: Request):
     
     For ASYNC inference:
     - SageMaker downloads input from S3 and sends to this endpoint
-    - We return JSON response
+    - We return the raw image bytes (metadata in X-* headers)
     - SageMaker uploads our response to S3 output location
 
     Supports:
@@ -94,11 +219,13 @@ async def invocations(request: Request):
       - text/plain: raw prompt string
     """
     content_type = request.headers.get("content-type", "")
-    
+    fmt = "webp"
+
     try:
         if "application/json" in content_type:
             body = await request.json()
-            
+            fmt = body.get("fmt", fmt)
+
             # Support both direct prompt and S3 input reference
             if "input_s3_uri" in body:
                 prompt = await _read_from_s3(body["input_s3_uri"])
@@ -112,6 +239,7 @@ async def invocations(request: Request):
         else:
             # Default: try JSON
             body = await request.json()
+            fmt = body.get("fmt", fmt)
             if "input_s3_uri" in body:
                 prompt = await _read_from_s3(body["input_s3_uri"])
             elif "prompt" in body:
@@ -119,17 +247,15 @@ async def invocations(request: Request):
             else:
                 raise HTTPException(status_code=400, detail="Request must contain 'prompt' or 'input_s3_uri'")
 
-        result = await _run_inference(prompt)
-        
-        # Add metadata for async inference tracking
-        result["inference_metadata"] = {
-            "model": "sdxl-turbo",
-            "timestamp": datetime.utcnow().isoformat(),
-            "content_type": content_type
-        }
+        # Raw bytes: SageMaker async uploads the response body to S3 verbatim,
+        # so skipping the base64/JSON wrapper saves a 1.33x payload expansion
+        # plus the encode CPU time. Tracking metadata rides in headers, which
+        # SageMaker preserves in the async output metadata object.
+        response = await _run_inference(prompt, fmt=fmt, raw=True)
+        response.headers["X-Model"] = "sdxl-turbo"
+        response.headers["X-Timestamp"] = datetime.utcnow().isoformat()
+        return response
 
-        return result
-        
     except Exception as e:
         logger.exception(f"Error in async inference: {e}")
         # Return error in format SageMaker can handle
@@ -143,44 +269,177 @@ async def invocations(request: Request):
         }
 
 
-async def _run_inference(prompt: str):
-    """Run SDXL-Turbo inference on the given prompt."""
-    logger.info(f"Inference request received for prompt: {prompt[:50]}...")
+@functools.cache
+def _s3_client():
+    """Build the pooled S3 client on first use.
 
-    if not prompt or not prompt.strip():
-        raise ValueError("Prompt cannot be empty")
+    boto3 is notoriously slow to import (~500ms of schema parsing), so defer
+    it until a request actually references S3 instead of paying it on every
+    container cold start. One client per process: rebuilding per request
+    re-walks the credential chain and opens a fresh TLS pool.
+    """
+    try:
+        import boto3
+        from botocore.config import Config
+    except ImportError:
+        raise ImportError("boto3 is required for S3 operations")
 
-    pipe = get_pipeline()
+    # Derive the client from an explicit Session so the credential provider
+    # chain (env -> config -> IMDS) is walked exactly once per process, even
+    # if other clients are created later
+    session = boto3.session.Session()
+    return session.client(
+        "s3",
+        config=Config(
+            max_pool_connections=50,
+            retries={"mode": "adaptive", "max_attempts": 3},
+            tcp_keepalive=True,
+        ),
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def _encode_prompt(prompt: str):
+    """Run the two SDXL text encoders for a prompt, cached by prompt string.
+
+    Production prompt traffic repeats heavily (retries, templated prompts,
+    A/B tests); a cache hit skips 5-15ms of text-encoder work per request.
+    """
+    with torch.inference_mode():
+        prompt_embeds, _, pooled_prompt_embeds, _ = _PIPE.encode_prompt(
+            prompt,
+            device=get_device(),
+            num_images_per_prompt=1,
+            do_classifier_free_guidance=False,
+        )
+    return prompt_embeds, pooled_prompt_embeds
 
-    if HAS_CUDA_AMP and torch.cuda.is_available():
-        ctx = autocast(enabled=True)
-        logger.info("Using CUDA with autocast...")
+
+def _do_infer(prompts: list):
+    """Blocking GPU section - runs on the dedicated inference thread."""
+    pipe = _PIPE
+
+    if torch.cuda.is_available() and not USE_ORT:
+        ctx = torch.autocast(device_type="cuda", dtype=inference_dtype())
+        # Pin attention to the fused flash/mem-efficient kernels; the math
+        # fallback silently costs 1.2-1.5x UNet throughput
+        attn_ctx = sdpa_kernel([SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION])
+        logger.info(f"Using CUDA with {inference_dtype()} autocast...")
+    elif ipex_optimized():
+        ctx = torch.autocast(device_type="cpu", dtype=torch.bfloat16)
+        attn_ctx = nullcontext()
+        logger.info("Using CPU inference with IPEX bf16 autocast...")
     else:
         ctx = nullcontext()
-        logger.info("Using CPU inference...")
+        attn_ctx = nullcontext()
+        logger.info("Using CPU/ORT inference...")
+
+    if USE_ORT:
+        prompt_kwargs = {"prompt": prompts}
+    else:
+        # Feed cached embeddings so the text encoders only run on cache miss
+        pairs = [_encode_prompt(p) for p in prompts]
+        prompt_kwargs = {
+            "prompt_embeds": torch.cat([embeds for embeds, _ in pairs]),
+            "pooled_prompt_embeds": torch.cat([pooled for _, pooled in pairs]),
+        }
 
-    with torch.inference_mode(), ctx:
-        logger.info("Beginning SDXL-Turbo inference...")
+    latents = None
+    if _LATENT_BUF is not None:
+        # Refill the persistent buffer in place; diffusers scales it by
+        # init_noise_sigma itself, so unit-normal noise is what it expects
+        latents = _LATENT_BUF[: len(prompts)]
+        latents.normal_(generator=_LATENT_GEN)
+
+    with torch.inference_mode(), ctx, attn_ctx:
+        logger.info(f"Beginning SDXL-Turbo inference (batch of {len(prompts)})...")
         result = pipe(
-            prompt, 
-            num_inference_steps=10, 
+            num_inference_steps=10,
             guidance_scale=0.0,  # Required for SDXL-Turbo
             height=512,
-            width=512
+            width=512,
+            latents=latents,
+            **prompt_kwargs
         )
 
-    image = result.images[0]
+    return result.images
+
+
+async def _batch_worker():
+    """Drain queued prompts into batched pipe(...) calls on the GPU thread."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _batch_queue.get()]
+
+        # Drain whatever else arrives within the batching window
+        deadline = loop.time() + MAX_WAIT_MS / 1000.0
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_batch_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        prompts = [prompt for prompt, _ in batch]
+        try:
+            async with _gpu_sema:
+                images = await loop.run_in_executor(_gpu_executor, _do_infer, prompts)
+            for (_, future), image in zip(batch, images):
+                if not future.done():
+                    future.set_result(image)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+async def _run_inference(prompt: str, fmt: str = "webp", raw: bool = False):
+    """Run SDXL-Turbo inference on the given prompt."""
+    logger.info(f"Inference request received for prompt: {prompt[:50]}...")
+
+    if not prompt or not prompt.strip():
+        raise ValueError("Prompt cannot be empty")
+
+    if fmt not in IMAGE_SAVE_KWARGS:
+        raise ValueError(f"Unsupported output format: {fmt}")
+
+    future = asyncio.get_running_loop().create_future()
+    await _batch_queue.put((prompt, future))
+    image = await future
+
+    # Encode on the default thread pool: the GPU is already free for the next
+    # batch, so request N's CPU post-processing overlaps request N+1's forward
+    logger.info(f"Encoding generated image as {fmt.upper()}...")
+    response = await asyncio.get_running_loop().run_in_executor(
+        None, _encode_image, image, fmt, raw, prompt
+    )
 
-    buffer = BytesIO()
-    logger.info("Saving generated image as PNG...")
-    image.save(buffer, format="PNG")
-    logger.info("Base64 encoding model output...")
-    encoded = base64.b64encode(buffer.getvalue()).decode("utf-8")
-    
     logger.info("Inference completed successfully")
+    return response
+
+
+def _encode_image(image, fmt: str, raw: bool, prompt: str):
+    """CPU post-processing (image encode + base64) - runs on a worker thread."""
+    buffer = BytesIO()
+    image.save(buffer, **IMAGE_SAVE_KWARGS[fmt])
+
+    if raw:
+        return Response(content=bytes(buffer.getbuffer()), media_type=f"image/{fmt}")
+
+    if HAS_PYBASE64:
+        # SIMD-accelerated encode straight from the buffer view to str,
+        # skipping the extra bytes copy + .decode() of the stdlib path
+        encoded = pybase64.b64encode_as_string(buffer.getbuffer())
+    else:
+        # b64encode accepts buffer-protocol objects, so feed the zero-copy
+        # memoryview instead of the bytes copy getvalue() would make
+        encoded = base64.b64encode(buffer.getbuffer()).decode("ascii")
+
     return {
         "image": encoded,
-        "format": "png",
+        "format": fmt,
         "size": {"width": 512, "height": 512},
         "prompt": prompt
     }
@@ -188,22 +447,22 @@ async def _run_inference(prompt: str):
 
 async def _read_from_s3(s3_uri: str) -> str:
     """Read input from S3 URI for async inference."""
-    if not HAS_BOTO3:
-        raise ImportError("boto3 is required for S3 operations")
-        
     logger.info(f"Reading input from S3: {s3_uri}")
-    
+
     # Parse S3 URI
     if not s3_uri.startswith("s3://"):
         raise ValueError("Invalid S3 URI format. Must start with s3://")
-        
+
     s3_path = s3_uri[5:]  # Remove 's3://'
     bucket, key = s3_path.split("/", 1)
-    
+
+    s3 = _s3_client()
+    from botocore.exceptions import ClientError
+
     try:
-        s3_client = boto3.client("s3")
-        response = s3_client.get_object(Bucket=bucket, Key=key)
-        content = response["Body"].read().decode("utf-8")
+        # Run the blocking botocore call off the event loop
+        response = await asyncio.to_thread(s3.get_object, Bucket=bucket, Key=key)
+        content = (await asyncio.to_thread(response["Body"].read)).decode("utf-8")
         
         # Try to parse as JSON first
         try:
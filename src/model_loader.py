@@ -3,10 +3,41 @@ import logging
 import os
 import torch
 from diffusers import AutoPipelineForText2Image
+from diffusers.models.attention_processor import AttnProcessor2_0
+
+try:
+    from torchao.quantization import quantize_, int8_weight_only
+    HAS_TORCHAO = True
+except ImportError:
+    HAS_TORCHAO = False
+
+try:
+    import intel_extension_for_pytorch as ipex
+    HAS_IPEX = True
+except ImportError:
+    HAS_IPEX = False
 
 logger = logging.getLogger(__name__)
 
+# Deployment-time constants - read once at import instead of per call
+MODEL_DIR = os.getenv("MODEL_DIR", "/opt/ml/model")
+MODEL_S3_LOCATION = os.getenv("MODEL_S3_LOCATION")
+USE_ORT = os.getenv("USE_ORT", "0") == "1"
+QUANTIZE_UNET = os.getenv("QUANTIZE_UNET", "0") == "1"
+
 _pipe = None
+_ipex_optimized = False
+_inference_dtype = torch.float32
+
+
+def inference_dtype():
+    """Weight/autocast dtype chosen at load time (bf16 on Ampere+, else fp16)."""
+    return _inference_dtype
+
+
+def ipex_optimized() -> bool:
+    """Whether the CPU pipeline was optimized with IPEX (bf16 autocast safe)."""
+    return _ipex_optimized
 
 
 def get_device() -> str:
@@ -17,17 +48,64 @@ def get_device() -> str:
     return "cpu"
 
 
+def _load_ort_pipeline(model_id: str, local_files_only: bool):
+    """Load the pipeline through ONNX Runtime (TensorRT EP, CUDA EP fallback).
+
+    Shapes here are fully static (1x512x512, fixed steps), which is the ideal
+    case for a TensorRT engine. Engines are cached under the model dir so only
+    the first cold start pays the build.
+    """
+    from optimum.onnxruntime import ORTStableDiffusionXLPipeline
+
+    trt_cache = os.path.join(MODEL_DIR, "trt_cache")
+    os.makedirs(trt_cache, exist_ok=True)
+
+    try:
+        pipe = ORTStableDiffusionXLPipeline.from_pretrained(
+            model_id,
+            export=True,
+            provider="TensorrtExecutionProvider",
+            provider_options={
+                "trt_engine_cache_enable": True,
+                "trt_engine_cache_path": trt_cache,
+                "trt_fp16_enable": True,
+            },
+            local_files_only=local_files_only,
+        )
+        logger.info("ORT pipeline loaded with TensorRT execution provider")
+    except Exception as e:
+        logger.warning(f"TensorRT EP unavailable ({e}); falling back to CUDA EP")
+        pipe = ORTStableDiffusionXLPipeline.from_pretrained(
+            model_id,
+            export=True,
+            provider="CUDAExecutionProvider",
+            local_files_only=local_files_only,
+        )
+    return pipe
+
+
 def get_pipeline():
     global _pipe
     if _pipe is not None:
         return _pipe
 
     device = get_device()
-    torch_dtype = torch.float16 if device == "cuda" else torch.float32
+    if device == "cuda":
+        # bf16 uses the same tensor-core path as fp16 but avoids overflow
+        # issues and matches the sdxl-turbo reference inference recipe.
+        # Pre-Ampere GPUs (e.g. T4 on g4dn) have no fast bf16, so keep fp16.
+        if torch.cuda.get_device_capability()[0] >= 8:
+            torch_dtype = torch.bfloat16
+        else:
+            torch_dtype = torch.float16
+    else:
+        torch_dtype = torch.float32
+
+    global _inference_dtype
+    _inference_dtype = torch_dtype
 
-    # Check for model location in environment variables
-    model_s3_location = os.getenv("MODEL_S3_LOCATION")
-    model_dir = os.getenv("MODEL_DIR", "/opt/ml/model")
+    model_s3_location = MODEL_S3_LOCATION
+    model_dir = MODEL_DIR
 
     if os.path.exists(os.path.join(model_dir, "model_index.json")):
         # SageMaker extracts model.tar.gz to /opt/ml/model automatically
@@ -49,12 +127,58 @@ def get_pipeline():
             logger.warning(f"MODEL_S3_LOCATION is set to {model_s3_location} but model not found in {model_dir}")
         local_files_only = False
 
+    if USE_ORT:
+        # Opt-in ONNX Runtime path; requires optimum[onnxruntime-gpu] in the
+        # image. The handler skips its torch-specific optimizations for this.
+        _pipe = _load_ort_pipeline(model_id, local_files_only)
+        return _pipe
+
+    load_kwargs = {}
+    if not local_files_only and device == "cuda":
+        # Hub fallback: fetch the fp16-variant weights (half the download
+        # size); they're cast to torch_dtype on load
+        load_kwargs["variant"] = "fp16"
+
     pipe = AutoPipelineForText2Image.from_pretrained(
         model_id,
         torch_dtype=torch_dtype,
         low_cpu_mem_usage=True,
         local_files_only=local_files_only,
+        **load_kwargs,
     ).to(device)
 
+    # tqdm bars cost time per call and spam the endpoint logs
+    pipe.set_progress_bar_config(disable=True)
+
+    # Attention slicing trades speed for memory - only worth it off-GPU
+    if device in ("mps", "cpu"):
+        pipe.enable_attention_slicing()
+
+    # Use the PyTorch 2.x scaled-dot-product attention kernels
+    # (flash/mem-efficient) instead of the naive einsum path: same math,
+    # O(N) instead of O(N^2) attention memory traffic
+    pipe.unet.set_attn_processor(AttnProcessor2_0())
+    pipe.vae.set_attn_processor(AttnProcessor2_0())
+
+    # CPU fallback otherwise runs fp32 eager - the slowest configuration.
+    # IPEX rewrites the UNet/VAE for oneDNN (AMX-BF16 tiles on recent Xeons);
+    # the handler then runs the forward under CPU bf16 autocast.
+    if device == "cpu" and HAS_IPEX:
+        global _ipex_optimized
+        logger.info("Applying IPEX bf16 optimization to UNet and VAE...")
+        pipe.unet = ipex.optimize(pipe.unet.eval(), dtype=torch.bfloat16, inplace=True)
+        pipe.vae = ipex.optimize(pipe.vae.eval(), dtype=torch.bfloat16, inplace=True)
+        _ipex_optimized = True
+
+    # Opt-in int8 weight-only quantization of the UNet. Only worthwhile when
+    # combined with torch.compile (the handler picks a compatible compile
+    # mode when this flag is set); halves UNet weight memory.
+    if device == "cuda" and QUANTIZE_UNET:
+        if HAS_TORCHAO:
+            logger.info("Quantizing UNet weights to int8 via torchao...")
+            quantize_(pipe.unet, int8_weight_only())
+        else:
+            logger.warning("QUANTIZE_UNET=1 but torchao is not installed; skipping")
+
     _pipe = pipe
     return _pipe
\ No newline at end of file